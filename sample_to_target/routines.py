@@ -1,11 +1,103 @@
-#acf - autocorrelation function
-from statsmodels.tsa.stattools import acf
-import scipy.stats
+#scipy and numba are imported where needed, they are slow to import
 import numpy as np
 import time
 import logging
+import functools
 logger = logging.getLogger("sample_to_target")
 
+#sample size above which sample_to_target switches to batch means estimator,
+#below it the estimate is too noisy compared to get_tau
+BATCH_MEANS_MIN_SIZE = 100_000
+#sample_to_target re-estimates tau every TAU_UPDATE_STRIDE doublings of the sample
+TAU_UPDATE_STRIDE = 2
+#block size for _shifted_sums, small enough for a block to stay in cache
+_SUMS_BLOCK_SIZE = 2**16
+#direct acf (numba) is O(n*nlags) and beats FFT only for few lags
+#or short samples, n*(nlags+1) is the number of multiply-adds
+DIRECT_ACF_MAX_LAGS = 100
+DIRECT_ACF_MAX_WORK = 500_000
+
+def _acf_fft(x, nlags):
+    """Autocorrelation function computed through FFT in O(n log n).
+    Computed along the last axis, so all rows of 2d array are done in one batch.
+
+    Args:
+        x (array): array of consecutive measurements
+        nlags (int): Number of lags to return
+
+    Returns:
+        array: autocorrelation function for lags 0..nlags
+    """
+    #Wiener-Khinchin theorem: power spectrum is the fourier transform of acf
+    #zero padding to at least 2n avoids circular correlation,
+    #next_fast_len picks the closest size with small prime factors
+    import scipy.fft
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[-1]
+    nfft = scipy.fft.next_fast_len(2*n, real = True)
+    #FFT runs in float32 to halve memory traffic, precision is enough for tau
+    #the mean is subtracted before the cast not to lose small fluctuations
+    x_centered = (x - np.mean(x, axis = -1, keepdims = True)).astype(np.float32)
+    f = scipy.fft.rfft(x_centered, n = nfft, axis = -1, workers = -1)
+    acov = scipy.fft.irfft(f*np.conjugate(f), n = nfft, axis = -1, workers = -1)[..., :min(nlags, n-1)+1]
+    return (acov/acov[..., :1]).astype(np.float64)
+
+@functools.lru_cache(maxsize = None)
+def _get_numba_kernels():
+    """Compiles _acf_fused and _cumsum_max with numba on the first call.
+    Returns None if numba (optional dependency) is not installed.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    #nogil lets get_tau_2d run the kernels in threads
+    #fastmath without nnan/ninf, so degenerate samples give nan as in _acf_fft
+    @numba.njit(cache = True, fastmath = {'reassoc', 'contract', 'arcp'}, nogil = True)
+    def _acf_fused(x, nlags):
+        """Autocorrelation function computed directly in O(n*nlags),
+        one fused pass over x per lag without temporary arrays.
+        Same estimator as _acf_fft.
+        """
+        n = x.shape[0]
+        mean = 0.0
+        for i in range(n):
+            mean += x[i]
+        mean /= n
+        nlags = min(nlags, n-1)
+        acov = np.empty(nlags+1)
+        for lag in range(nlags+1):
+            s = 0.0
+            for i in range(n-lag):
+                s += (x[i]-mean)*(x[i+lag]-mean)
+            acov[lag] = s
+        return acov/acov[0]
+
+    @numba.njit(cache = True, nogil = True)
+    def _cumsum_max(a):
+        """Same as np.cumsum(a).max() in one pass without temporary array."""
+        s = 0.0
+        m = -np.inf
+        for v in a:
+            s += v
+            #nan propagates like in np.max
+            if s != s:
+                return s
+            if s > m:
+                m = s
+        return m
+    return _acf_fused, _cumsum_max
+
+def _direct_acf_kernels(n, nlags):
+    """numba kernels if direct acf of n measurements with nlags lags
+    is expected to be faster than FFT, otherwise None.
+    """
+    nlags = min(nlags, n-1)
+    if nlags > DIRECT_ACF_MAX_LAGS and n*(nlags+1) > DIRECT_ACF_MAX_WORK:
+        return None
+    return _get_numba_kernels()
+
 def get_tau(x, acf_n_lags : int = 200):
     """Get the integrated autocorrelation time i.e. the distance between measurements
     when the data can be considered uncorrelated.
@@ -20,17 +112,159 @@ def get_tau(x, acf_n_lags : int = 200):
     #References:
     #https://www.physik.uni-leipzig.de/~janke/Paper/nic10_423_2002.pdf
     #https://dfm.io/posts/autocorr/
-    acf_arr = acf(x, nlags = acf_n_lags)
     #integrated autocorrelation time
     #ideally integral of acf monotonically approaches some value
     #though due to calculations errors it does not hold
-    #for that reason we use max(np.cumsum(acf_arr)) instead of simple sum(acf_arr)
-    tau_int =1/2+max(np.cumsum(acf_arr))
+    #for that reason we use max of np.cumsum(acf_arr) instead of simple sum(acf_arr)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    kernels = _direct_acf_kernels(len(x), acf_n_lags)
+    if kernels is not None:
+        _acf_fused, _cumsum_max = kernels
+        acf_arr = _acf_fused(x, acf_n_lags)
+        tau_int = 1/2 + _cumsum_max(acf_arr)
+    else:
+        acf_arr = _acf_fft(x, acf_n_lags)
+        tau_int = 1/2 + np.cumsum(acf_arr).max()
+    return tau_int
+
+def get_tau_batch_means(x):
+    """Get the integrated autocorrelation time with the batch means method.
+    Single pass O(n) alternative to get_tau, suited for long samples.
+
+    The sample is split into k = n^(1/3) batches of size m = n^(2/3). Variance of
+    the batch means multiplied by m estimates the variance of the sample mean
+    times n, its ratio to the sample variance is 2*tau.
+
+    The result is shifted by 1 to follow get_tau convention (get_tau sums
+    acf starting from lag 0), so both give ~1.5 for uncorrelated data.
+    With only k batches the estimate is noisy, relative error is about
+    sqrt(2/k): ~20% for 1e5 measurements, ~15% for 1e6.
+
+    Args:
+        x (array): array of consecutive measurements
+
+    Returns:
+        float: integrated autocorrelation time
+    """
+    #References:
+    #https://www.physik.uni-leipzig.de/~janke/Paper/nic10_423_2002.pdf
+    #https://arxiv.org/abs/1011.0175
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    m = int(n**(2/3))
+    k = n//m
+    batch_means = x[:k*m].reshape(k, m).mean(axis=1)
+    #m*var(batch_means)/var(x) = 1 + 2*sum(acf[1:]), while
+    #get_tau = 1/2 + sum(acf[0:]) = 3/2 + sum(acf[1:])
+    tau_int = m*batch_means.var(ddof=1)/x.var(ddof=1)/2 + 1
+    return tau_int
+
+def _estimate_tau(x):
+    #acf integration for short samples, batch means for long ones
+    if len(x) > BATCH_MEANS_MIN_SIZE:
+        return get_tau_batch_means(x)
+    return get_tau(x)
+
+def get_tau_2d(x, acf_n_lags : int = 200):
+    """Get the integrated autocorrelation time for every row of x, see get_tau.
+    ACF of all rows is calculated with one batched FFT. For long rows and
+    few lags (DIRECT_ACF_MAX_LAGS or less) rows are processed in parallel
+    threads with numba kernels instead, if numba is installed.
+
+    Args:
+        x (array): 2d array, every row is an array of consecutive measurements
+        acf_n_lags (int, optional): Number of lags calculated with ACF. Defaults to 200.
+
+    Returns:
+        array: integrated autocorrelation time of every row
+    """
+    x = np.asarray(x, dtype=np.float64)
+    #batched FFT has no per row overhead, unlike get_tau it is
+    #faster for short rows, threads pay off only with enough work per row
+    n = x.shape[-1]
+    if (acf_n_lags <= DIRECT_ACF_MAX_LAGS and n*(acf_n_lags+1) > DIRECT_ACF_MAX_WORK
+            and _get_numba_kernels() is not None):
+        from concurrent.futures import ThreadPoolExecutor
+        rows = x.reshape(-1, x.shape[-1])
+        #numba kernels release GIL, so threads run on all cores
+        with ThreadPoolExecutor() as executor:
+            tau_int = list(executor.map(lambda row: get_tau(row, acf_n_lags), rows))
+        return np.reshape(tau_int, x.shape[:-1])
+    acf_arr = _acf_fft(x, acf_n_lags)
+    tau_int = 1/2 + np.cumsum(acf_arr, axis = -1).max(axis = -1)
     return tau_int
 
-get_tau_2d = np.vectorize(get_tau, signature='(n)->()', excluded=['acf_n_lags'])
+@functools.lru_cache(maxsize = 512)
+def _t_value(q, df):
+    import scipy.stats
+    return float(scipy.stats.t.ppf(q, df))
 
-def correlated_data_mean_err(x, tau, ci = 0.95):
+@functools.lru_cache(maxsize = None)
+def _make_z_fn(ci = 0.95):
+    """Returns function of effective sample size n_eff giving z (or t) value
+    for the margin of error, specialized for confidence interval level ci.
+    Built once per ci, values are cached, so calls do not reach scipy.
+    """
+    # 1-(1-ci)/2 comes from the fact that we are excluding values
+    # outside confidence interval from both tails of distribution
+    q = 1-(1-ci)/2
+    # if the sample size is big enough, t distribution
+    # is close to normal distribution, and we use the latter
+    # z = ppf(1-(1-ci)/2), 1.96 for the most common ci = 0.95
+    # where ppf - the percent point function or
+    # the inverse cumulative distribution function
+    # of normal distribution
+    if ci == 0.95:
+        z_normal = 1.96
+    else:
+        import scipy.stats
+        z_normal = float(scipy.stats.norm.ppf(q))
+
+    def z_fn(n_eff):
+        if n_eff>30:
+            return z_normal
+        # otherwise we calculate it from t distribution
+        # degrees of freedom are rounded down to 0.1 to hit the cache
+        return _t_value(q, max(int(n_eff*10), 1)/10)
+    return z_fn
+
+def _shifted_sums(x, shift):
+    """Sum and sum of squares of x - shift and the size of x,
+    see _mean_err_from_sums.
+    """
+    #x - shift is taken block by block, so the whole shifted copy is never
+    #allocated and each block is summed while it is still in cache,
+    #x is read from memory once
+    s1 = 0.0
+    s2 = 0.0
+    for i in range(0, np.size(x), _SUMS_BLOCK_SIZE):
+        x_shifted = x[i:i + _SUMS_BLOCK_SIZE] - shift
+        s1 += np.sum(x_shifted)
+        s2 += np.dot(x_shifted, x_shifted)
+    return s1, s2, np.size(x)
+
+def _mean_err_from_sums(s1, s2, n, tau, z_fn, shift = 0.0):
+    """Mean and the margin of error of correlated sample given
+    sum s1 and sum of squares s2 of its n measurements shifted by shift,
+    z_fn is made by _make_z_fn.
+    """
+    #variance from sums needs one pass over the data instead of
+    #separate mean and std passes, but s2/n - mean^2 loses precision
+    #for data with a large offset (e.g. energies), so the sums are taken
+    #around shift close to the mean, i.e. the first measurement
+    x_mean = s1/n
+    x_var = max(s2/n - x_mean*x_mean, 0.0)
+    x_mean = x_mean + shift
+    #the sample is correlated so the effective size is smaller
+    n_eff = n/(2*tau)
+    #print(f"Effective sample size: {n_eff}")
+    z = z_fn(n_eff)
+    #print(f"z: {z}")
+    err = np.sqrt(x_var/n_eff) * z
+    #print(f"mean: {x_mean};  error: {err}")
+    return x_mean, err
+
+def correlated_data_mean_err(x, tau, ci = 0.95, compute_err = True):
     """Returns the mean and the confidence interval of correlated sample.
     That distribution mean lies in sample mean +/- error with a probability of
     conference interval level (95% in most cases).
@@ -45,35 +279,24 @@ def correlated_data_mean_err(x, tau, ci = 0.95):
         x (array): correlated sample
         tau (float): integrated autocorrelation time
         ci (float, optional): Confidence interval level. Defaults to 0.95.
+        compute_err (bool, optional): If False only the mean is calculated
+            and the margin of error is None. Defaults to True.
 
     Returns:
-        (float, float): sample mean and the margin of error
+        (float, float): sample mean and the margin of error,
+            both are nan for an empty sample
     """
     ##References:
     #http://www.stat.yale.edu/Courses/1997-98/101/confint.html
     #https://en.wikipedia.org/wiki/Confidence_interval
-    x_mean = np.mean(x)
-
-    #the sample is correlated so the effective size is smaller
-    n_eff = np.size(x)/(2*tau)
-    #print(f"Effective sample size: {n_eff}")
-    if n_eff>30 and ci == 0.95:
-        # the most common case when the sample size is big enough
-        # we use normal distribution
-        # z = ppf(1-(1-0.95)/2) = 1.96
-        # where ppf - the percent point function or
-        # the inverse cumulative distribution function
-        # of normal distribution
-        z = 1.96
-    else:
-        # otherwise we calculate it from t distribution
-        # 1-(1-ci)/2 comes from the fact that we are excluding values
-        # outside confidence interval from both tails of distribution
-        z=scipy.stats.t.ppf(1-(1-ci)/2, n_eff)
-    #print(f"z: {z}")
-    err = np.std(x)/np.sqrt(n_eff) * z
-    #print(f"mean: {x_mean};  error: {err}")
-    return x_mean, err
+    x = np.ravel(np.asarray(x, dtype=np.float64))
+    if np.size(x) == 0:
+        return np.nan, (np.nan if compute_err else None)
+    if not compute_err:
+        return np.mean(x), None
+    shift = x[0]
+    s1, s2, n = _shifted_sums(x, shift)
+    return _mean_err_from_sums(s1, s2, n, tau, _make_z_fn(ci), shift)
 
 def sample_to_target(
         get_data_callback,
@@ -92,7 +315,7 @@ def sample_to_target(
         3) check if any of the criteria to end loop meet
         4) while no criterion meat
             5) double the sample size
-            6) update autocorr time
+            6) update autocorr time (every TAU_UPDATE_STRIDE doublings)
             7) check end loop
         8) returns mean, margin of errors, sample size
 
@@ -117,60 +340,103 @@ def sample_to_target(
     Returns:
         tuple: Returns mean value, margins of error and effective sample size
     """
-    #stop sampling criteria
-    def end_loop(elapsed_time, current_error, eff_sample_size):
-        if elapsed_time > timeout:
-            logger.info('Reached timeout')
-            return True
-        #check if kwarg provided
-        elif target_error is not None:
-            if current_error <= target_error:
-                logger.info("Reached target error")
-                return True
-        elif target_eff_sample_size is not None:
-            if eff_sample_size >= target_eff_sample_size:
-                logger.info("Reached effective sample size")
-                return True
-        else:
-            return False
+    #stop sampling criteria, sampling stops when any of them is reached
+    want_err = target_error is not None
+    want_ess = target_eff_sample_size is not None
+    #margin of error is needed in the loop only for target_error or debug logs
+    compute_err = want_err or logger.isEnabledFor(logging.DEBUG)
+    z_fn = _make_z_fn(ci)
     #init timer
     start_time = time.time()
     n_samples = initial_sample_size
     #first sample
-    x = get_data_callback(n_samples)
+    #callback may return a list, convert once to homogeneous float array
+    x = np.asarray(get_data_callback(n_samples), dtype=np.float64)
     #if non autocorr time provided
-    if tau is None: tau = get_tau(x)
-    #correlated data mean and err margin
-    x_mean, x_err = correlated_data_mean_err(x, tau, ci)
+    #estimate it now and update as the sample grows
+    update_tau = tau is None
+    if update_tau: tau = _estimate_tau(x)
+    iter_count = 0
+    #running sums, so the mean and the variance are updated
+    #with the new samples only instead of the whole x
+    shift = x[0]
+    s1, s2, n = _shifted_sums(x, shift)
+    #samples are needed only to re-estimate tau, they are stored
+    #in a buffer with spare capacity, only buffer[:n] holds the data
+    buffer = x.copy() if update_tau else None
     #sampling loop
     while True:
         #time passed
         logger.debug(f'Criteria are not reached')
         #append new sample (correlated)
-        new_sample = get_data_callback(n_samples)
-        x=np.append(x, new_sample)
+        new_sample = np.asarray(get_data_callback(n_samples), dtype=np.float64)
+        n_new = np.size(new_sample)
+        if update_tau:
+            if n + n_new > buffer.size:
+                #every chunk is as big as the whole sample so far,
+                #reserve room for the next chunk as well
+                grown = np.empty(2*(n + n_new), dtype=np.float64)
+                grown[:n] = buffer[:n]
+                buffer = grown
+            buffer[n:n + n_new] = new_sample
+        s1_new, s2_new, _ = _shifted_sums(new_sample, shift)
+        s1 += s1_new
+        s2 += s2_new
+        n += n_new
+        iter_count += 1
         #if non autocorr time provided
-        if tau is None: tau = get_tau(new_sample)
+        #estimate converges slowly, no need to update on every doubling
+        if update_tau and iter_count % TAU_UPDATE_STRIDE == 0:
+            tau = _estimate_tau(buffer[:n])
         #next time take twice the amount of data points
         n_samples = n_samples*2
         #err, sample size, time passed
-        x_mean, x_err = correlated_data_mean_err(x, tau, ci)
-        n_samples_eff = n_samples/(2*tau)
+        if compute_err:
+            x_mean, x_err = _mean_err_from_sums(s1, s2, n, tau, z_fn, shift)
+        else:
+            x_mean, x_err = s1/n + shift, None
+        n_samples_eff = n/(2*tau)
         elapsed_time = time.time() - start_time
         logger.debug((x_err, n_samples_eff, elapsed_time))
         #stop sampling?
-        if end_loop(elapsed_time, x_err, n_samples_eff):
+        if elapsed_time > timeout:
+            logger.info('Reached timeout')
+            break
+        if want_err and x_err <= target_error:
+            logger.info("Reached target error")
+            break
+        if want_ess and n_samples_eff >= target_eff_sample_size:
+            logger.info("Reached effective sample size")
             break
     #Done
+    if x_err is None:
+        x_mean, x_err = _mean_err_from_sums(s1, s2, n, tau, z_fn, shift)
     logger.info(
         f"Mean: {x_mean}, margin of error: {x_err},\n" +\
-        f"  sample size: {n_samples}, eff_sample_size: {n_samples/(2*tau)},\n" +\
+        f"  sample size: {n}, eff_sample_size: {n_samples_eff},\n" +\
         f"  elapsed time: {elapsed_time}"
         )
-    return x_mean, x_err, n_samples/(2*tau)
+    return x_mean, x_err, n_samples_eff
 
 #for highly autocorrelated data consider using downsampling prior to sample_to_target routine
 def downsample(x, dist):
-    import random
-    n_chunks = int(len(x)/dist)
-    return [random.choice(chunk) for chunk in np.array_split(x,n_chunks)]
\ No newline at end of file
+    """Picks one random measurement from every chunk of dist consecutive measurements.
+    Incomplete trailing chunk gives one measurement as well.
+
+    Args:
+        x (array): array of consecutive measurements
+        dist (int): chunk size, i.e. the mean distance between picked measurements
+
+    Returns:
+        array: downsampled measurements
+    """
+    x = np.asarray(x)
+    n_chunks = len(x)//dist
+    #one chunk per row, then one random column from each row
+    chunks = x[:n_chunks*dist].reshape(n_chunks, dist)
+    idx = np.random.randint(0, dist, size = n_chunks)
+    picks = chunks[np.arange(n_chunks), idx]
+    tail = x[n_chunks*dist:]
+    if len(tail):
+        picks = np.concatenate((picks, [np.random.choice(tail)]))
+    return picks
@@ -11,5 +11,6 @@ setup(
     author='Laktionov Mikhail',
     author_email = 'miklakt@gmail.com',
     packages=['sample_to_target'],
-    install_requires=['numpy', 'scipy', 'statsmodels']
+    install_requires=['numpy', 'scipy'],
+    extras_require={'numba': ['numba']}
 )
\ No newline at end of file